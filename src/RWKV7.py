@@ -17,10 +17,16 @@ if local_build:
             "LD_LIBRARY_PATH": f"{BUILD}:{CUDA_STUBS}",
             "LLAMA_CPP_LIB": os.path.join(BUILD, "libllama.so"),
         }
+        if "SSMPROV_DEBUG_IO" in os.environ:  # survive the re-exec
+            env["SSMPROV_DEBUG_IO"] = os.environ["SSMPROV_DEBUG_IO"]
         os.execve(sys.executable, [sys.executable, *sys.argv], env)
 
 from llama_cpp import Llama
 
+# echo each request line to stderr (off by default; it runs on every request)
+_DEBUG_IO = bool(os.environ.get("SSMPROV_DEBUG_IO"))
+DEBUG_IO_MAX = 4096  # truncate echoed lines past this many chars
+
 MAX_CHARS = 8192
 TEMP      = 0.70
 TOP_P     = 0.95
@@ -328,22 +334,33 @@ def main():
     HOST = "127.0.0.1"
     PORT = 6502
     NULL = b"\x00"
-    CHUNK = 4096
+    CHUNK = 64*1024
 
     def recv_until_null(conn):
-        buf = bytearray()
+        # recv_into one growing buffer; only the freshly received bytes are scanned for NULL
+        buf = bytearray(CHUNK); end = 0
         while True:
-            data = conn.recv(CHUNK)
-            if not data:
+            if end == len(buf):
+                buf.extend(bytes(len(buf)))
+            with memoryview(buf) as mv:
+                n = conn.recv_into(mv[end:])
+            if not n:
                 return None  # client closed
-            i = data.find(NULL)
+            i = buf.find(NULL, end, end + n)
             if i != -1:
-                buf.extend(data[:i])
-                r = bytes(buf)
-                if r and r[-1] == 0:  # keep required NULL strip; add guard
-                    r = r[:-1]
-                return r
-            buf.extend(data)
+                del buf[i:]
+                return buf
+            end += n
+
+    def send_reply(conn, data: bytes):
+        # reply and NULL terminator in one sendmsg (no concatenated copy), resuming partial sends
+        views = [memoryview(data), memoryview(NULL)]
+        while views:
+            sent = conn.sendmsg(views)
+            while views and sent >= len(views[0]):
+                sent -= len(views.pop(0))
+            if sent:
+                views[0] = views[0][sent:]
 
     if not os.path.exists(MODEL):
         raise FileNotFoundError(MODEL)
@@ -367,6 +384,7 @@ def main():
 
         while True:
             conn, addr = srv.accept()
+            conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)  # one reply per connection
             try:
                 raw = recv_until_null(conn)
                 if raw is None:
@@ -426,7 +444,8 @@ def main():
 
 
 
-                print("LINE: "+'"'+line+'"')
+                if _DEBUG_IO:
+                    sys.stderr.write('LINE: "' + line[:DEBUG_IO_MAX] + '"\n')
 
                 parts = line.split(maxsplit=1)
                 head = parts[0].lower() if parts else ""
@@ -445,7 +464,7 @@ def main():
                         out = f"[saved -> {path} ({n} bytes)]\n"
                     except Exception as e:
                         out = f"[save error] {e}\n"
-                    conn.sendall(out.encode("utf-8", errors="ignore") + NULL)
+                    send_reply(conn, out.encode("utf-8", errors="ignore"))
                     continue
                 # /load (minimal state)
                 if head == "/load":
@@ -455,7 +474,7 @@ def main():
                         out = f"[loaded <- {path}]\n"
                     except Exception as e:
                         out = f"[load error] {e}\n"
-                    conn.sendall(out.encode("utf-8", errors="ignore") + NULL)
+                    send_reply(conn, out.encode("utf-8", errors="ignore"))
                     continue
 
                 # /save_set (sampling knobs)
@@ -470,7 +489,7 @@ def main():
                         out = f"[saved set -> {path} ({n} bytes)]\n"
                     except Exception as e:
                         out = f"[save_set error] {e}\n"
-                    conn.sendall(out.encode("utf-8", "ignore") + NULL)
+                    send_reply(conn, out.encode("utf-8", "ignore"))
                     continue
 
                 # /load_set (sampling knobs)
@@ -487,7 +506,7 @@ def main():
                         out = f"[loaded set <- {path}]\n"
                     except Exception as e:
                         out = f"[load_set error] {e}\n"
-                    conn.sendall(out.encode("utf-8", "ignore") + NULL)
+                    send_reply(conn, out.encode("utf-8", "ignore"))
                     continue
 
                 # /t (temperature)
@@ -497,7 +516,7 @@ def main():
                         except Exception: pass
                         conn.sendall(NULL)  # empty ack on set
                     else:
-                        conn.sendall(f"temp = {temp}".encode("utf-8","ignore") + NULL)
+                        send_reply(conn, f"temp = {temp}".encode("utf-8","ignore"))
                     continue
 
                 # /k (top_k)
@@ -507,7 +526,7 @@ def main():
                         except Exception: pass
                         conn.sendall(NULL)
                     else:
-                        conn.sendall(f"top_k = {top_k}".encode("utf-8","ignore") + NULL)
+                        send_reply(conn, f"top_k = {top_k}".encode("utf-8","ignore"))
                     continue
 
                 # /p (top_p)
@@ -517,7 +536,7 @@ def main():
                         except Exception: pass
                         conn.sendall(NULL)
                     else:
-                        conn.sendall(f"top_p = {top_p}".encode("utf-8","ignore") + NULL)
+                        send_reply(conn, f"top_p = {top_p}".encode("utf-8","ignore"))
                     continue
 
                 # /pen_freq (frequency_penalty)
@@ -527,7 +546,7 @@ def main():
                         except Exception: pass
                         conn.sendall(NULL)
                     else:
-                        conn.sendall(f"pen_freq = {pen_freq}".encode("utf-8","ignore") + NULL)
+                        send_reply(conn, f"pen_freq = {pen_freq}".encode("utf-8","ignore"))
                     continue
 
                 # /pen_pres (presence_penalty)
@@ -537,7 +556,7 @@ def main():
                         except Exception: pass
                         conn.sendall(NULL)
                     else:
-                        conn.sendall(f"pen_pres = {pen_pres}".encode("utf-8","ignore") + NULL)
+                        send_reply(conn, f"pen_pres = {pen_pres}".encode("utf-8","ignore"))
                     continue
 
                 # /pen_rep (repeat_penalty)
@@ -547,7 +566,7 @@ def main():
                         except Exception: pass
                         conn.sendall(NULL)
                     else:
-                        conn.sendall(f"pen_rep = {pen_rep}".encode("utf-8","ignore") + NULL)
+                        send_reply(conn, f"pen_rep = {pen_rep}".encode("utf-8","ignore"))
                     continue
 
                 # /? (help + current settings)
@@ -560,7 +579,7 @@ def main():
                         pen_pres=pen_pres,
                         pen_rep=pen_rep,
                     )
-                    conn.sendall(out.encode("utf-8", errors="ignore") + NULL)
+                    send_reply(conn, out.encode("utf-8", errors="ignore"))
                     continue
 
                 # Unrecognized slash-commands: ignore (match CLI)
@@ -588,7 +607,7 @@ def main():
                 except Exception as e:
                     reply = f"[error] {e}"
 
-                conn.sendall(reply.encode("utf-8", errors="ignore") + NULL)
+                send_reply(conn, reply.encode("utf-8", errors="ignore"))
 
             finally:
                 conn.close()
@@ -9,9 +9,21 @@
 #   - /save, /load, /save_set, /load_set, /t, /p, /k, /pen_freq, /pen_pres, /pen_rep, /min_p, /?
 #   - optional leading "!" header: "!checkpoint set next_checkpoint\n<your prompt>"
 #
-# It re-execs itself with LD_LIBRARY_PATH so llama_cpp hits your local ~/src/llama.cpp build.
-
-import os, sys, pickle, ctypes, json, socket
+# It preloads your local ~/src/llama.cpp build so llama_cpp binds to it (re-exec with
+# LD_LIBRARY_PATH as a fallback).
+
+import os, sys, errno, pickle, ctypes, json, socket, functools, struct, mmap, threading, queue, atexit, itertools
+from array import array
+from types import SimpleNamespace
+
+try:
+    import zstandard as zstd  # optional: compress saved states
+except ImportError:
+    zstd = None
+try:
+    import orjson  # optional: faster knob-set JSON
+except ImportError:
+    orjson = None
 
 # ---- paths / build env -------------------------------------------------------
 local_build = True  # use llama.cpp in ~/src/llama.cpp/build/bin
@@ -19,20 +31,58 @@ BUILD = os.path.expanduser("~/src/llama.cpp/build/bin")    # libllama.so & frien
 CUDA_STUBS = "/usr/lib/x86_64-linux-gnu"                   # driver libs (Ubuntu)
 MODEL = os.path.expanduser("~/models/rwkv7/rwkv7-g0a-7.2b-20250829-ctx4096-Q8_0.gguf")
 
-if local_build:
-    # Re-exec with env so llama_cpp loads local CUDA libllama.so (and your GPU kernels)
-    if "LL_REEXEC" not in os.environ:
+# load order matters: each library's deps must already be resident when it is dlopen'd
+BUILD_LIBS = ("libggml-base.so", "libggml-cpu.so", "libggml-cuda.so", "libggml.so", "libllama.so")
+
+LOCAL_LIBLLAMA = os.path.join(BUILD, "libllama.so")
+
+def _preload_local_build() -> bool:
+    """dlopen the local build RTLD_GLOBAL so llama_cpp's own CDLL reuses these handles.
+
+    True only once LOCAL_LIBLLAMA itself has been loaded."""
+    if not os.path.exists(LOCAL_LIBLLAMA):
+        return False
+    try:
+        drv = os.path.join(CUDA_STUBS, "libcuda.so.1")
+        if os.path.exists(drv):
+            ctypes.CDLL(drv, mode=ctypes.RTLD_GLOBAL)
+        for name in BUILD_LIBS:
+            lib = os.path.join(BUILD, name)
+            if os.path.exists(lib):
+                ctypes.CDLL(lib, mode=ctypes.RTLD_GLOBAL)
+    except OSError:
+        return False
+    return True
+
+if local_build and "LL_REEXEC" not in os.environ:
+    # Point llama_cpp at the local libllama.so (LLAMA_CPP_LIB_PATH: current llama_cpp,
+    # LLAMA_CPP_LIB: older releases) once it is preloaded; if a transitive dependency
+    # can't be resolved from here, re-exec with LD_LIBRARY_PATH as before. With no local
+    # build the environment is left alone and llama_cpp uses its bundled library.
+    if _preload_local_build():
+        os.environ["LLAMA_CPP_LIB_PATH"] = BUILD
+        os.environ["LLAMA_CPP_LIB"] = LOCAL_LIBLLAMA
+    elif os.path.exists(LOCAL_LIBLLAMA):
         env = {
             "LL_REEXEC": "1",
             "HOME": os.path.expanduser("~"),
             "PATH": "/usr/bin",
             "LD_LIBRARY_PATH": f"{BUILD}:{CUDA_STUBS}",
-            "LLAMA_CPP_LIB": os.path.join(BUILD, "libllama.so"),
+            "LLAMA_CPP_LIB_PATH": BUILD,
+            "LLAMA_CPP_LIB": LOCAL_LIBLLAMA,
         }
+        if "GGML_CUDA_DISABLE_GRAPHS" in os.environ:  # carried over, see below
+            env["GGML_CUDA_DISABLE_GRAPHS"] = os.environ["GGML_CUDA_DISABLE_GRAPHS"]
         os.execve(sys.executable, [sys.executable, *sys.argv], env)
 
 # ---- llama.cpp driver --------------------------------------------------------
+# ggml-cuda captures/replays the single-token decode graph and stages offload through
+# pinned host buffers unless told otherwise. GGML_CUDA_DISABLE_GRAPHS is the user's switch
+# (e.g. around a CUDA-graph bug) and is left as set; GGML_CUDA_NO_PINNED is cleared.
+os.environ.pop("GGML_CUDA_NO_PINNED", None)
+
 from llama_cpp import Llama
+from llama_cpp import llama_cpp as C
 
 # defaults (kept close to your RWKV runner; Mamba tip: min_p ~= 0.05–0.10 often helps)
 MAX_CHARS = 4*1024
@@ -44,74 +94,429 @@ PEN_PRES  = 0.00
 PEN_REP   = 1.00
 MIN_P     = 0.12
 
+# slash command -> (knob name, parser); bare command echoes "name = value"
+KNOBS = {
+    "/t":        ("temp", float),
+    "/p":        ("top_p", float),
+    "/k":        ("top_k", int),
+    "/min_p":    ("min_p", float),
+    "/pen_freq": ("pen_freq", float),
+    "/pen_pres": ("pen_pres", float),
+    "/pen_rep":  ("pen_rep", float),
+}
+
 # stop-marker helpers (same behavior as RWKV runner)
 mark1 = "\n~~~("
 mark2 = ")~~~\n\n"
 mark3 = "end)~~"
 FORCE_AFTER  = "end)~~~\n\n"
 FORCE_AFTER3 = "~\n\n"
+FORCE_AFTER_B, FORCE_AFTER3_B = FORCE_AFTER.encode(), FORCE_AFTER3.encode()
+
+def _build_mark_dfa(marks):
+    """Aho–Corasick over the marks, flattened to a 256-column table.
+
+    next state = trans[state*256 + byte]; bit i of out[state] is set when marks[i] ends there.
+    """
+    goto, fail, out = [{}], [0], [0]
+    for i, m in enumerate(marks):
+        s = 0
+        for b in m.encode("utf-8"):
+            if b not in goto[s]:
+                goto.append({}); fail.append(0); out.append(0)
+                goto[s][b] = len(goto) - 1
+            s = goto[s][b]
+        out[s] |= 1 << i
+    if len(goto) > 256:
+        raise ValueError("stop markers too long for a byte-state table")
+    trans = bytearray(256 * len(goto))
+    order = [0]  # breadth-first, so every fail target's row is already filled in
+    for s in order:
+        for c in range(256):
+            nxt = goto[s].get(c)
+            back = trans[fail[s]*256 + c] if s else 0
+            if nxt is None:
+                trans[s*256 + c] = back
+            else:
+                fail[nxt] = back
+                out[nxt] |= out[back]
+                trans[s*256 + c] = nxt
+                order.append(nxt)
+    return bytes(trans), out
+
+MARK_DFA, MARK_OUT = _build_mark_dfa((mark1, mark2, mark3))
+HIT1, HIT2, HIT3 = 1, 2, 4
+
+def _mark_step(st: int, piece: bytes) -> tuple:
+    """Run piece through the mark DFA from st: (piece, state, hits, end1, end3, nchars).
+
+    end1/end3 are where the last mark1/mark3 ended inside piece (-1 if none); nchars counts
+    characters, i.e. bytes that aren't UTF-8 continuations."""
+    hits = 0
+    end1 = end3 = -1
+    nchars = 0
+    for k, b in enumerate(piece):
+        if b & 0xC0 != 0x80:
+            nchars += 1
+        st = MARK_DFA[st*256 + b]
+        f = MARK_OUT[st]
+        if f:
+            hits |= f
+            if f & HIT1: end1 = k + 1
+            if f & HIT3: end3 = k + 1
+    return piece, st, hits, end1, end3, nchars
+
+# (DFA state, token id) -> _mark_step result; pieces are fixed per token (one model per
+# process) and only a handful of DFA states exist, so replies soon run from this alone
+_STEPS = {}
+
+N_GPU_LAYERS = 999  # full offload if possible
+CPU_THREADS  = 8
+
+def _fully_offloaded(llm: Llama) -> bool:
+    """Whether every layer (and the output layer) really sits on a GPU device."""
+    if not C.llama_supports_gpu_offload():
+        return False
+    try:
+        dev = _ggml("ggml_backend_dev_by_type", ctypes.c_void_p, ctypes.c_int)(GGML_BACKEND_DEVICE_TYPE_GPU)
+    except AttributeError:
+        return False
+    return bool(dev) and N_GPU_LAYERS > int(C.llama_model_n_layer(llm.model))
 
 def make_llm() -> Llama:
-    return Llama(
+    llm = Llama(
         model_path=MODEL,
         n_ctx=64*1024,     # suppress warning; real context governed by model/kv
-        n_gpu_layers=999,  # full offload if possible
-        n_threads=8,
+        n_gpu_layers=N_GPU_LAYERS,
+        n_threads=CPU_THREADS,
+        n_threads_batch=CPU_THREADS,
+        # decode goes one token per llama_decode (CUDA-graph path); n_batch/n_ubatch stay
+        # at their defaults so prompt prefill is still batched. There is no attention (so
+        # no flash_attn); offload_kqv is what keeps the recurrent state cache on the GPU.
+        offload_kqv=True,
         verbose=False,
     )
+    # With every layer on the GPU the CPU threads only spin and contend with the launch
+    # thread, so drop to one; partial offload or no GPU device keeps the thread pool.
+    if _fully_offloaded(llm):
+        C.llama_set_n_threads(_ctx_ptr(llm), 1, 1)
+        llm.n_threads = llm.n_threads_batch = 1
+    _rebase(llm, None)
+    return llm
 
 # ---- low-level ctx access (unchanged) ---------------------------------------
 def _ctx_ptr(llm: Llama):
     _ctx = getattr(llm, "_ctx", None)
     return getattr(_ctx, "ctx", None) or _ctx
 
+# Every captured/loaded state gets a seq; llm._applied_state_seq names the one the context
+# currently holds (None once it has moved on), so re-applying it can be skipped.
+_STATE_SEQ = itertools.count(1)
+
+# llm._base is the last state with a blob the context was set to (None: the fresh context)
+# and llm._fed every token _decode has fed it since; a live handle can be rebuilt from the
+# two (see restore_state). Each rebase starts a new array, so a handle's stays intact.
+EMPTY_STATE = {"blob": b"", "n_tokens": 0}
+
+def _rebase(llm: Llama, st):
+    llm._base = st
+    llm._fed = array("i")
+
+# One page-locked host buffer that state copies are staged through, so the device<->host
+# transfer is a straight DMA instead of the driver's pageable bounce. It comes from ggml's
+# own host buffer type for the GPU device (the pinned memory the backend itself uses), is
+# allocated once and only replaced by a bigger one when a state outgrows it. It is scratch
+# only: captured blobs are copied out of it and loaded ones into it, so no state_obj (or
+# queued save) ever points at it. With no GPU device or host buffer type, copies go direct.
+GGML_BACKEND_DEVICE_TYPE_GPU = 1
+_STAGE = None         # (ggml_backend_buffer_t, ctypes uint8 array over its memory)
+_STAGE_OFF = False    # set once staging turned out to be unavailable
+
+def _ggml(name: str, restype, *argtypes):
+    f = getattr(C._lib, name)  # ggml's symbols resolve through libllama's handle
+    f.restype, f.argtypes = restype, list(argtypes)
+    return f
+
+def _staging(n: int):
+    """The pinned staging buffer, grown to hold n bytes if needed, or None without one."""
+    global _STAGE, _STAGE_OFF
+    if _STAGE_OFF:
+        return None
+    if _STAGE is not None and len(_STAGE[1]) >= n:
+        return _STAGE[1]
+    vp = ctypes.c_void_p
+    try:
+        dev = _ggml("ggml_backend_dev_by_type", vp, ctypes.c_int)(GGML_BACKEND_DEVICE_TYPE_GPU)
+        if not dev:  # CPU-only: nothing to stage for
+            _STAGE_OFF = True
+            return None
+        buft = _ggml("ggml_backend_dev_host_buffer_type", vp, vp)(dev)
+        if not buft:
+            raise RuntimeError("no GPU host buffer type")
+        cap = n + n // 8  # headroom: the output-logits part of the state can grow a little
+        buf = _ggml("ggml_backend_buft_alloc_buffer", vp, vp, ctypes.c_size_t)(buft, cap)
+        base = buf and _ggml("ggml_backend_buffer_get_base", vp, vp)(buf)
+        if not base:
+            raise RuntimeError(f"host buffer allocation of {cap} bytes failed")
+    except (AttributeError, RuntimeError) as e:
+        _STAGE_OFF = True
+        print(f"[pinned] {e}; state copies go direct", file=sys.stderr, flush=True)
+        return None
+    if _STAGE is not None:
+        _ggml("ggml_backend_buffer_free", None, vp)(_STAGE[0])
+    _STAGE = (buf, (ctypes.c_uint8 * cap).from_address(base))
+    return _STAGE[1]
+
 def capture_state_min(llm: Llama) -> dict:
-    """Return minimal state: {'blob': bytes, 'n_tokens': int}."""
+    """Return minimal state: {'blob': memoryview, 'n_tokens': int, 'seq': int}."""
     ntok = int(getattr(llm, "n_tokens", 0))
-    try:
-        blob = llm.save_state()
-        if isinstance(blob, (bytes, bytearray, memoryview)):
-            return {"blob": bytes(blob), "n_tokens": ntok}
-    except Exception:
-        pass
-    from llama_cpp import llama_cpp as C
+    if ntok == 0:
+        # nothing has been fed yet: an empty blob stands for the fresh context (see
+        # apply_state_min), skipping a full state-size copy off the device
+        seq = next(_STATE_SEQ)
+        llm._applied_state_seq = seq
+        st = {"blob": b"", "n_tokens": 0, "seq": seq}
+        _rebase(llm, st)
+        return st
+    # Llama.save_state() returns a LlamaState (plus input_ids/scores copies), never raw
+    # bytes, so go straight to the context copy.
     ctx = _ctx_ptr(llm)
     if ctx is None:
         raise RuntimeError("Unable to access llama context pointer for state copy.")
+    # a fresh blob buffer per capture: the previous state_obj may still be queued for
+    # saving, so it can't be reused
     size = int(C.llama_get_state_size(ctx))
-    buf = (ctypes.c_uint8 * size)()
-    wrote = int(C.llama_copy_state_data(ctx, buf))
-    return {"blob": bytes(buf[:wrote]), "n_tokens": ntok}
+    pin = _staging(size)
+    if pin is not None:
+        wrote = int(C.llama_copy_state_data(ctx, pin))
+        buf = bytearray(memoryview(pin).cast("B")[:wrote])
+    else:
+        buf = bytearray(size)
+        wrote = int(C.llama_copy_state_data(ctx, _u8_ptr(buf)))
+    seq = next(_STATE_SEQ)
+    llm._applied_state_seq = seq
+    st = {"blob": memoryview(buf)[:wrote], "n_tokens": ntok, "seq": seq}
+    _rebase(llm, st)
+    return st
+
+def _u8_ptr(blob):
+    """Pointer to blob's bytes for the llama state copy calls, without copying them."""
+    if isinstance(blob, bytes):
+        return ctypes.cast(ctypes.c_char_p(blob), ctypes.POINTER(ctypes.c_uint8))
+    return (ctypes.c_uint8 * len(blob)).from_buffer(blob)  # writable buffers (bytearray, mmap)
 
 def apply_state_min(llm: Llama, st: dict):
     """Apply minimal state produced by capture_state_min."""
     blob = st["blob"]
+    llm._applied_state_seq = None
     llm.reset()
-    try:
-        llm.load_state(blob)
-    except Exception:
-        from llama_cpp import llama_cpp as C
-        ctx = _ctx_ptr(llm)
-        if ctx is None:
-            raise RuntimeError("Unable to access llama context pointer for state set.")
-        Arr = ctypes.c_uint8 * len(blob)
-        if int(C.llama_set_state_data(ctx, Arr.from_buffer_copy(blob))) != len(blob):
-            raise RuntimeError("llama_set_state_data wrote fewer bytes than expected")
+    _rebase(llm, None)  # until st is fully in place
+    if not blob:  # empty-context state from capture_state_min
+        llm._ctx.kv_cache_clear()
+        _rebase(llm, st)
+        llm._applied_state_seq = st.get("seq")
+        return
+    ctx = _ctx_ptr(llm)
+    if ctx is None:
+        raise RuntimeError("Unable to access llama context pointer for state set.")
+    pin = _staging(len(blob))
+    if pin is not None:
+        memoryview(pin).cast("B")[:len(blob)] = blob
+        src = pin
+    else:
+        src = _u8_ptr(blob)
+    if int(C.llama_set_state_data(ctx, src)) != len(blob):
+        raise RuntimeError("llama_set_state_data wrote fewer bytes than expected")
     llm.n_tokens = int(st.get("n_tokens", 0))
+    _rebase(llm, st)
+    llm._applied_state_seq = st.get("seq")
+
+def live_state(llm: Llama) -> dict:
+    """Handle for the state the context holds right now, without copying it out.
+
+    It has no 'blob' until one is needed (see materialize_state), just what restore_state
+    needs to rebuild it: the base state and the tokens fed on top of it."""
+    seq = next(_STATE_SEQ)
+    llm._applied_state_seq = seq
+    return {"n_tokens": int(getattr(llm, "n_tokens", 0)), "seq": seq,
+            "base": llm._base, "fed": llm._fed, "n_fed": len(llm._fed)}
+
+def restore_state(llm: Llama, st: dict):
+    """Put the context back to st: apply its blob, or for a live handle re-apply its base
+    and feed the same tokens again (a failed turn leaves the context part-way through one)."""
+    if "blob" in st:
+        apply_state_min(llm, st)
+        return
+    toks = st["fed"][:st["n_fed"]]
+    apply_state_min(llm, st["base"] or EMPTY_STATE)
+    if toks:
+        _decode(llm, toks)
+    llm._applied_state_seq = st["seq"]
+
+def materialize_state(llm: Llama, st) -> dict:
+    """Return st with its blob, capturing the context now if st is None or live (rebuilt
+    first if the context has moved on)."""
+    if st is not None and "blob" in st:
+        return st
+    if st is not None and st.get("seq") != getattr(llm, "_applied_state_seq", None):
+        restore_state(llm, st)
+    return capture_state_min(llm)
 
 # ---- persistence of state & sampling knobs ----------------------------------
+# state file: STATE_HDR (magic, codec, n_tokens, raw_len, payload_len), zero-padded to
+# STATE_PAYLOAD_OFF so the payload is page-aligned and can be mapped on its own.
+# SSMV1 files (payload right after the header) still load.
+STATE_MAGIC = b"SSMV2"
+STATE_HDR = struct.Struct("<5sBQQQ")
+STATE_PAYLOAD_OFF = 4096
+PAYLOAD_OFFSETS = {b"SSMV1": STATE_HDR.size, STATE_MAGIC: STATE_PAYLOAD_OFF}
+CODEC_RAW, CODEC_ZSTD = 0, 1
+
+SAVE_CHUNK = 4*1024*1024
+
+def _write_all(f, mv):
+    # unbuffered FileIO.write may take less than it was handed
+    while mv:
+        mv = mv[f.write(mv):]
+
+def _write_state_direct(path, hdr_block, payload) -> bool:
+    """Write hdr_block + payload with O_DIRECT through an aligned bounce buffer.
+
+    The tail is zero-padded to a whole block and cut back with ftruncate. Returns False
+    (nothing useful written) where the platform or filesystem doesn't take O_DIRECT."""
+    if not hasattr(os, "O_DIRECT"):
+        return False
+    try:
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC | os.O_DIRECT, 0o644)
+    except OSError:
+        return False  # e.g. tmpfs
+    try:
+        bounce = mmap.mmap(-1, SAVE_CHUNK)  # anonymous maps are page-aligned
+        with memoryview(bounce) as bv, memoryview(payload) as pv:
+            bv[:len(hdr_block)] = hdr_block
+            fill, total = len(hdr_block), len(hdr_block) + len(pv)
+            off = 0
+            while True:
+                k = min(SAVE_CHUNK - fill, len(pv) - off)
+                bv[fill:fill + k] = pv[off:off + k]
+                fill += k; off += k
+                if fill < SAVE_CHUNK and off < len(pv):
+                    continue
+                n = -(-fill // STATE_PAYLOAD_OFF) * STATE_PAYLOAD_OFF
+                bv[fill:n] = bytes(n - fill)
+                done = 0
+                while done < n:
+                    done += os.write(fd, bv[done:n])
+                fill = 0
+                if off >= len(pv):
+                    break
+        bounce.close()
+        os.ftruncate(fd, total)
+        os.fdatasync(fd)
+    except OSError as e:
+        if e.errno == errno.EINVAL:  # alignment rules this filesystem won't meet
+            return False
+        raise
+    finally:
+        os.close(fd)
+    return True
+
 def save_state_min(state_obj: dict, path="kv.pkl") -> int:
     if not state_obj:
         raise RuntimeError("No state to save yet. Say something first.")
+    blob = state_obj["blob"]
+    if zstd is not None and blob:
+        codec, payload = CODEC_ZSTD, zstd.ZstdCompressor(level=3, threads=-1).compress(blob)
+    else:
+        codec, payload = CODEC_RAW, blob
+    hdr = STATE_HDR.pack(STATE_MAGIC, codec, int(state_obj.get("n_tokens", 0)), len(blob), len(payload))
     tmp = path + ".tmp"
-    with open(tmp, "wb") as f:
-        pickle.dump({"blob": state_obj["blob"], "n_tokens": int(state_obj.get("n_tokens", 0))}, f, protocol=pickle.HIGHEST_PROTOCOL)
+    hdr_block = hdr.ljust(STATE_PAYLOAD_OFF, b"\0")
+    if _write_state_direct(tmp, hdr_block, payload):
+        os.replace(tmp, path)
+        return os.path.getsize(path)
+    with open(tmp, "wb", buffering=0) as f:
+        _write_all(f, memoryview(hdr_block))
+        with memoryview(payload) as mv:
+            for off in range(0, len(mv), SAVE_CHUNK):
+                _write_all(f, mv[off:off + SAVE_CHUNK])
+        if hasattr(os, "posix_fadvise"):
+            # one-shot blob: once it's on disk, don't let it crowd the page cache
+            os.fdatasync(f.fileno())
+            os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_DONTNEED)
     os.replace(tmp, path)
     return os.path.getsize(path)
 
-def load_state_min(llm: Llama, path="kv.pkl") -> dict:
+def read_state_file(path: str) -> dict:
+    """Parse a state file; raw payloads come back as a view onto a private mmap."""
     with open(path, "rb") as f:
-        st = pickle.load(f)
+        hdr = f.read(STATE_HDR.size)
+        off = PAYLOAD_OFFSETS.get(hdr[:len(STATE_MAGIC)]) if len(hdr) == STATE_HDR.size else None
+        if off is None:
+            f.seek(0)
+            return pickle.load(f)  # pre-SSMV1 state file
+        _, codec, ntok, raw_len, payload_len = STATE_HDR.unpack(hdr)
+        if os.fstat(f.fileno()).st_size < off + payload_len:
+            raise RuntimeError(f"truncated state file: {path}")
+        # map just the payload (from the page it starts in); ACCESS_COPY makes it
+        # writable for ctypes from_buffer, but pages are never dirtied
+        base = off - off % mmap.ALLOCATIONGRANULARITY
+        if payload_len:
+            mm = mmap.mmap(f.fileno(), off - base + payload_len, access=mmap.ACCESS_COPY, offset=base)
+            payload = memoryview(mm)[off - base:]
+        else:
+            mm, payload = None, memoryview(b"")
+    if codec == CODEC_RAW:
+        blob = payload
+    elif codec == CODEC_ZSTD:
+        if zstd is None:
+            raise RuntimeError("state file is zstd-compressed; install 'zstandard' to load it")
+        blob = zstd.ZstdDecompressor().decompress(payload, max_output_size=raw_len)
+        payload.release()
+        if mm is not None:
+            mm.close()
+    else:
+        raise RuntimeError(f"unknown state codec {codec} in {path}")
+    if len(blob) != raw_len:
+        raise RuntimeError(f"corrupt state file: {path}")
+    return {"blob": blob, "n_tokens": ntok}
+
+# /save and "!" post-saves are written by one background thread so the reply isn't held up;
+# a write that fails is reported ahead of the next reply, whatever the request
+_SAVE_Q = queue.Queue()
+_SAVE_ERRORS = queue.SimpleQueue()
+
+def _save_worker():
+    while True:
+        state_obj, path = _SAVE_Q.get()
+        try:
+            save_state_min(state_obj, path)
+        except Exception as e:
+            print(f"[save error] {path}: {e}", file=sys.stderr, flush=True)
+            _SAVE_ERRORS.put(f"[save error] {path}: {e}\n")
+        finally:
+            _SAVE_Q.task_done()
+
+def take_save_errors() -> bytes:
+    """Failed background writes not yet reported, as reply text (b"" if none)."""
+    out = []
+    while True:
+        try:
+            out.append(_SAVE_ERRORS.get_nowait())
+        except queue.Empty:
+            return "".join(out).encode("utf-8", "ignore")
+
+def queue_save(state_obj: dict, path="kv.pkl") -> int:
+    """Hand a captured state to the writer thread; returns the state size in bytes."""
+    if not state_obj:
+        raise RuntimeError("No state to save yet. Say something first.")
+    _SAVE_Q.put((state_obj, path))
+    return len(state_obj["blob"])
+
+def load_state_min(llm: Llama, path="kv.pkl") -> dict:
+    _SAVE_Q.join()  # a /load right after a /save must see the finished file
+    st = read_state_file(path)
+    st["seq"] = next(_STATE_SEQ)
     apply_state_min(llm, st)
     return st
 
@@ -121,15 +526,17 @@ def save_knob_set(path: str, *, temp, top_p, top_k, pen_freq, pen_pres, pen_rep,
         "pen_freq": float(pen_freq), "pen_pres": float(pen_pres), "pen_rep": float(pen_rep),
         "min_p": float(min_p),
     }
+    raw = orjson.dumps(data) if orjson else json.dumps(data, separators=(",", ":")).encode("utf-8")
     tmp = path + ".tmp"
-    with open(tmp, "w", encoding="utf-8") as f:
-        json.dump(data, f, separators=(",", ":"))
+    with open(tmp, "wb") as f:
+        f.write(raw)
     os.replace(tmp, path)
-    return os.path.getsize(path)
+    return len(raw)
 
 def load_knob_set(path: str) -> dict:
-    with open(path, "r", encoding="utf-8") as f:
-        d = json.load(f)
+    with open(path, "rb") as f:
+        raw = f.read()
+    d = orjson.loads(raw) if orjson else json.loads(raw)
     return {
         "temp": float(d.get("temp", TEMP)),
         "top_p": float(d.get("top_p", TOP_P)),
@@ -140,6 +547,99 @@ def load_knob_set(path: str) -> dict:
         "min_p": float(d.get("min_p", MIN_P)),
     }
 
+# ---- direct llama.cpp decode (no per-token Llama.sample/eval wrappers) ------
+_BATCH = None   # one llama_batch for prefill and generation, allocated on first use
+_BATCH_CAP = 0
+
+def _batch(llm: Llama):
+    global _BATCH, _BATCH_CAP
+    if _BATCH is None:
+        cap = max(1, int(llm.n_batch))
+        b = C.llama_batch_init(cap, 0, 1)
+        for j in range(cap):  # single sequence, logits off; only token/pos change per call
+            b.n_seq_id[j] = 1
+            b.seq_id[j][0] = 0
+            b.logits[j] = 0
+        _BATCH, _BATCH_CAP = b, cap
+    return _BATCH, _BATCH_CAP
+
+def _decode(llm: Llama, toks, n=None):
+    """Feed toks (c_int32 array or int sequence) through llama_decode in n_batch slabs."""
+    ctx = _ctx_ptr(llm)
+    batch, cap = _batch(llm)
+    n = len(toks) if n is None else n
+    arr = isinstance(toks, ctypes.Array)
+    for i in range(0, n, cap):
+        m = min(cap, n - i)
+        n_past = llm.n_tokens
+        if arr:
+            ctypes.memmove(batch.token, ctypes.addressof(toks) + i * _TOK_W, m * _TOK_W)
+        for j in range(m):
+            if not arr:
+                batch.token[j] = toks[i + j]
+            batch.pos[j] = n_past + j
+        batch.logits[m - 1] = 1
+        batch.n_tokens = m
+        rc = int(C.llama_decode(ctx, batch))
+        batch.logits[m - 1] = 0
+        if rc != 0:
+            raise RuntimeError(f"llama_decode failed ({rc})")
+        llm.n_tokens = n_past + m
+        if arr:
+            llm._fed.frombytes(ctypes.string_at(ctypes.addressof(toks) + i * _TOK_W, m * _TOK_W))
+        else:
+            llm._fed.extend(toks[i:i + m])
+
+_TOK_BUF = (ctypes.c_int32 * (32*1024))()  # prompt token ids, grown on demand
+_TOK_W = ctypes.sizeof(ctypes.c_int32)
+
+def _tokenize(llm: Llama, data: bytes):
+    """llama_tokenize straight into _TOK_BUF (same flags as llm.tokenize(data, add_bos=False)); returns (buf, n)."""
+    global _TOK_BUF
+    vocab = llm._model.vocab
+    n = int(C.llama_tokenize(vocab, data, len(data), _TOK_BUF, len(_TOK_BUF), False, False))
+    if n < 0:
+        _TOK_BUF = (ctypes.c_int32 * -n)()
+        n = int(C.llama_tokenize(vocab, data, len(data), _TOK_BUF, len(_TOK_BUF), False, False))
+    return _TOK_BUF, n
+
+def _piece(llm: Llama, tok_id: int, buf) -> bytes:
+    """Detokenize a single token into raw bytes (no BOS/space handling needed mid-reply)."""
+    n = int(C.llama_token_to_piece(llm._model.vocab, tok_id, buf, len(buf), 0, False))
+    if n < 0:  # piece longer than buf
+        buf = ctypes.create_string_buffer(-n)
+        n = int(C.llama_token_to_piece(llm._model.vocab, tok_id, buf, len(buf), 0, False))
+    return ctypes.string_at(buf, n)
+
+@functools.lru_cache(maxsize=64)
+def _force_toks(llm: Llama, missing: bytes) -> tuple:
+    """Tokens for a forced trailer suffix; only a handful of FORCE_AFTER*/[m:] values exist."""
+    return tuple(llm.tokenize(missing, add_bos=False))
+
+_SMPL = None      # sampler chain reused across turns; rebuilt only when the knobs change
+_SMPL_KEY = None
+
+def _sampler(llm: Llama, key: tuple):
+    """Sampler chain for key = (temp, top_p, top_k, min_p, pen_freq, pen_pres, pen_rep)."""
+    global _SMPL, _SMPL_KEY
+    if key != _SMPL_KEY:
+        if _SMPL is not None:
+            _SMPL.close()
+        temp, top_p, top_k, min_p, pen_freq, pen_pres, pen_rep = key
+        _SMPL = llm._init_sampler(
+            temp=temp,
+            top_p=top_p,
+            top_k=top_k,
+            min_p=min_p,
+            frequency_penalty=pen_freq,
+            presence_penalty=pen_pres,
+            repeat_penalty=pen_rep,
+        )
+        _SMPL_KEY = key
+    else:
+        C.llama_sampler_reset(_SMPL.sampler)  # penalty history starts fresh each reply
+    return _SMPL
+
 # ---- token loop with your stop/force rules ----------------------------------
 def gen_until_stop(
     llm: Llama, *,
@@ -152,80 +652,75 @@ def gen_until_stop(
     pen_rep=PEN_REP,
     min_p=MIN_P,
 ) -> str:
-    text = ""
+    ctx = _ctx_ptr(llm)
+    # one sampler chain for the whole reply (Llama.sample builds a chain per token)
+    smpl = _sampler(llm, (temp, top_p, top_k, min_p, pen_freq, pen_pres, pen_rep))
+    pbuf = ctypes.create_string_buffer(64)
+    out = bytearray()  # raw reply bytes; decoded once at the end
+    nchars = 0
+    st = 0  # marker DFA state, carried across pieces
+    steps = _STEPS
     while True:
-        tok_id = llm.sample(
-            temp=temp,
-            top_p=top_p,
-            top_k=top_k,
-            min_p=min_p,                  # NEW
-            frequency_penalty=pen_freq,
-            presence_penalty=pen_pres,
-            repeat_penalty=pen_rep,
-        )
+        tok_id = int(C.llama_sampler_sample(smpl.sampler, ctx, -1))
         if tok_id == 0:
             break
 
-        piece = llm.detokenize([tok_id]).decode("utf-8", errors="ignore")
-        text += piece
-
-        if len(text) > max_chars:
+        step = steps.get((st, tok_id))
+        if step is None:
+            step = steps[(st, tok_id)] = _mark_step(st, _piece(llm, tok_id, pbuf))
+        piece, st, hits, end1, end3, n = step
+        nchars += n
+
+        if not hits and nchars <= max_chars:
+            # the token is kept: queue its decode first (llama_decode doesn't wait for the
+            # device; the next sample does) so the append below overlaps the GPU work
+            _decode(llm, (tok_id,))
+            out += piece
+            continue
+
+        out += piece
+        if nchars > max_chars:
             break
-        if mark2 in text:
+        if hits & HIT2:
             break
 
-        j = text.rfind(mark3)
-        if j != -1:
-            llm.eval([tok_id])
-            after  = text[j + len(mark3):]
-            target = FORCE_AFTER3
+        if hits & (HIT3 | HIT1):
+            # close the fence: mark3 wins over mark1, then force whatever of the trailer is
+            # missing; the sampled token and the forced ones go through one llama_decode
+            end, target = (end3, FORCE_AFTER3_B) if hits & HIT3 else (end1, FORCE_AFTER_B)
+            after  = piece[end:]
             m = 0
             while m < len(after) and m < len(target) and after[m] == target[m]:
                 m += 1
             missing = target[m:]
+            forced = (tok_id,)
             if missing:
-                text += missing
-                toks = llm.tokenize(missing.encode("utf-8"), add_bos=False)
-                if toks:
-                    llm.eval(toks)
+                out += missing
+                forced += _force_toks(llm, missing)
+            _decode(llm, forced)
             break
 
-        i = text.rfind(mark1)
-        if i != -1:
-            llm.eval([tok_id])
-            after  = text[i + len(mark1):]
-            target = FORCE_AFTER
-            m = 0
-            while m < len(after) and m < len(target) and after[m] == target[m]:
-                m += 1
-            missing = target[m:]
-            if missing:
-                text += missing
-                toks = llm.tokenize(missing.encode("utf-8"), add_bos=False)
-                if toks:
-                    llm.eval(toks)
-            break
-
-        llm.eval([tok_id])
-
-    return text
-
-def turn(llm: Llama,
-         user_text: str,
-         state_obj, *,
-         max_chars=MAX_CHARS,
-         temp=TEMP,
-         top_k=TOP_K,
-         top_p=TOP_P,
-         pen_freq=PEN_FREQ,
-         pen_pres=PEN_PRES,
-         pen_rep=PEN_REP,
-         min_p=MIN_P):
+    return out.decode("utf-8", errors="ignore")
+
+def turn_generate(llm: Llama,
+                  user_text: str,
+                  state_obj, *,
+                  max_chars=MAX_CHARS,
+                  temp=TEMP,
+                  top_k=TOP_K,
+                  top_p=TOP_P,
+                  pen_freq=PEN_FREQ,
+                  pen_pres=PEN_PRES,
+                  pen_rep=PEN_REP,
+                  min_p=MIN_P) -> str:
     if state_obj is not None:
-        apply_state_min(llm, state_obj)
+        seq = state_obj.get("seq")
+        if seq is None or seq != getattr(llm, "_applied_state_seq", None):
+            restore_state(llm, state_obj)
+    llm._applied_state_seq = None  # the context moves past state_obj from here on
 
-    toks = llm.tokenize(user_text.encode("utf-8"), add_bos=False)
-    llm.eval(toks)
+    toks, n = _tokenize(llm, user_text.encode("utf-8"))
+    _decode(llm, toks, n)
 
     reply = gen_until_stop(
         llm,
@@ -238,8 +733,11 @@ def turn(llm: Llama,
         pen_rep=pen_rep,
         min_p=min_p,
     )
-    new_state = capture_state_min(llm)
-    return reply, new_state
+    return reply
+
+def turn_capture(llm: Llama) -> dict:
+    """State after turn_generate: a live handle, only copied out on /save or post-save."""
+    return live_state(llm)
 
 def make_help_text(*, temp, top_p, top_k, pen_freq, pen_pres, pen_rep, min_p):
     return f"""\
@@ -251,7 +749,8 @@ _Falcon-Mamba-Instruct-7B, GGUF_
 - Slash-prefixed commands configure generation parameters.
 
 ## Commands
-- `/save [file]` — Save KV state (default: kv.pkl)
+- `/save [file]` — Save KV state (default: kv.pkl); written in the background,
+	a failed write is reported ahead of the next reply.
 - `/load [file]` — Load KV state (default: kv.pkl)
 - `/save_set [file]` — Save current tuning knobs (default: set.json)
 - `/load_set [file]` — Load tuning knobs (default: set.json)
@@ -302,33 +801,121 @@ def main():
     HOST = "127.0.0.1"
     PORT = 6502
     NULL = b"\x00"
-    CHUNK = 4096
+    CHUNK = 64*1024
 
     def recv_until_null(conn):
-        buf = bytearray()
+        # recv_into one growing buffer; only the freshly received bytes are scanned for NULL
+        buf = bytearray(CHUNK); end = 0
         while True:
-            data = conn.recv(CHUNK)
-            if not data:
+            if end == len(buf):
+                buf.extend(bytes(len(buf)))
+            with memoryview(buf) as mv:
+                n = conn.recv_into(mv[end:])
+            if not n:
                 return None  # client closed
-            i = data.find(NULL)
+            i = buf.find(NULL, end, end + n)
             if i != -1:
-                buf.extend(data[:i])
-                r = bytes(buf)
-                if r and r[-1] == 0:
-                    r = r[:-1]
-                return r
-            buf.extend(data)
+                del buf[i:]
+                return buf
+            end += n
+
+    def send_reply(conn, data: bytes):
+        # reply and NULL terminator in one sendmsg (no concatenated copy), resuming partial sends
+        views = [memoryview(data), memoryview(NULL)]
+        while views:
+            sent = conn.sendmsg(views)
+            while views and sent >= len(views[0]):
+                sent -= len(views.pop(0))
+            if sent:
+                views[0] = views[0][sent:]
 
     if not os.path.exists(MODEL):
         raise FileNotFoundError(MODEL)
 
     llm = make_llm()
+    print(f"[MAMBA TCP] {llm.n_threads} CPU thread(s): "
+          + ("model fully offloaded to the GPU" if _fully_offloaded(llm) else "CPU or partial offload"))
+    threading.Thread(target=_save_worker, name="state-saver", daemon=True).start()
+    atexit.register(_SAVE_Q.join)  # let queued saves finish on a normal exit / Ctrl-C
     state_obj = None
     default_path = "kv.pkl"
     default_set_path = "set.json"
-    temp = TEMP; top_p = TOP_P; top_k = TOP_K
-    pen_freq = PEN_FREQ; pen_pres = PEN_PRES; pen_rep = PEN_REP
-    min_p = MIN_P
+    S = SimpleNamespace(temp=TEMP, top_p=TOP_P, top_k=TOP_K,
+                        pen_freq=PEN_FREQ, pen_pres=PEN_PRES, pen_rep=PEN_REP,
+                        min_p=MIN_P)
+    help_key = help_b = None  # encoded /? text and the knob values it shows
+
+    # --- slash commands: head -> handler(conn, arg) ---
+    def h_save(conn, arg):
+        nonlocal state_obj
+        path = arg or default_path
+        try:
+            state_obj = materialize_state(llm, state_obj)
+            n = queue_save(state_obj, path)
+            out = f"[saving -> {path} (state: {n} bytes before encoding)]\n"
+        except Exception as e:
+            out = f"[save error] {e}\n"
+        send_reply(conn, out.encode("utf-8", "ignore"))
+
+    def h_load(conn, arg):
+        nonlocal state_obj
+        path = arg or default_path
+        try:
+            state_obj = load_state_min(llm, path)
+            out = f"[loaded <- {path}]\n"
+        except Exception as e:
+            out = f"[load error] {e}\n"
+        # load_state_min waited for pending saves; say if one of them just failed
+        send_reply(conn, take_save_errors() + out.encode("utf-8", "ignore"))
+
+    def h_max(conn, arg):
+        global MAX_CHARS
+        if arg:
+            try:
+                MAX_CHARS = max(1, int(arg))
+            except Exception:
+                pass
+            conn.sendall(NULL)
+        else:
+            send_reply(conn, f"max = {MAX_CHARS}".encode("utf-8","ignore"))
+
+    def h_save_set(conn, arg):
+        path = arg or default_set_path
+        try:
+            n = save_knob_set(path, **vars(S))
+            out = f"[saved set -> {path} ({n} bytes)]\n"
+        except Exception as e:
+            out = f"[save_set error] {e}\n"
+        send_reply(conn, out.encode("utf-8", "ignore"))
+
+    def h_load_set(conn, arg):
+        path = arg or default_set_path
+        try:
+            vars(S).update(load_knob_set(path))
+            out = f"[loaded set <- {path}]\n"
+        except Exception as e:
+            out = f"[load_set error] {e}\n"
+        send_reply(conn, out.encode("utf-8", "ignore"))
+
+    def h_knob(name, parse, conn, arg):
+        if arg:
+            try: setattr(S, name, parse(arg))
+            except Exception: pass
+            conn.sendall(NULL)
+        else:
+            send_reply(conn, f"{name} = {getattr(S, name)}".encode("utf-8","ignore"))
+
+    def h_help(conn, arg):
+        nonlocal help_key, help_b
+        key = tuple(vars(S).values())
+        if key != help_key:  # only re-render after a knob changed
+            help_key = key
+            help_b = make_help_text(**vars(S)).encode("utf-8","ignore")
+        send_reply(conn, help_b)
+
+    HANDLERS = {"/save": h_save, "/load": h_load, "/max": h_max,
+                "/save_set": h_save_set, "/load_set": h_load_set, "/?": h_help}
+    HANDLERS.update((head, functools.partial(h_knob, *spec)) for head, spec in KNOBS.items())
 
     with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as srv:
         srv.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
@@ -338,11 +925,15 @@ def main():
 
         while True:
             conn, addr = srv.accept()
+            conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)  # one reply per connection
             try:
                 raw = recv_until_null(conn)
                 if raw is None:
                     conn.sendall(NULL)
                     continue
+                errs = take_save_errors()
+                if errs:
+                    conn.sendall(errs)  # ahead of this request's own reply
 
                 line = raw.decode("utf-8", errors="ignore").strip()
                 pending_post_save = None
@@ -351,9 +942,8 @@ def main():
                     nonlocal pending_post_save, state_obj
                     if pending_post_save:
                         try:
-                            if state_obj is None:
-                                state_obj = capture_state_min(llm)
-                            save_state_min(state_obj, pending_post_save)
+                            state_obj = materialize_state(llm, state_obj)
+                            queue_save(state_obj, pending_post_save)
                         except Exception:
                             pass
                         pending_post_save = None
@@ -369,10 +959,7 @@ def main():
                             pass
                     if len(args) >= 2:
                         try:
-                            cfg = load_knob_set(args[1])
-                            temp = cfg["temp"]; top_p = cfg["top_p"]; top_k = cfg["top_k"]
-                            pen_freq = cfg["pen_freq"]; pen_pres = cfg["pen_pres"]; pen_rep = cfg["pen_rep"]
-                            min_p = cfg["min_p"]
+                            vars(S).update(load_knob_set(args[1]))
                         except Exception:
                             pass
                     if len(args) >= 3:
@@ -384,130 +971,9 @@ def main():
                 arg = parts[1].strip() if len(parts) > 1 else ""
 
                 # --- commands (identical to RWKV runner + min_p) ---
-                if head == "/save":
-                    path = arg or default_path
-                    try:
-                        if state_obj is None:
-                            state_obj = capture_state_min(llm)
-                        n = save_state_min(state_obj, path)
-                        out = f"[saved -> {path} ({n} bytes)]\n"
-                    except Exception as e:
-                        out = f"[save error] {e}\n"
-                    conn.sendall(out.encode("utf-8", "ignore") + NULL); continue
-
-                if head == "/load":
-                    path = arg or default_path
-                    try:
-                        state_obj = load_state_min(llm, path)
-                        out = f"[loaded <- {path}]\n"
-                    except Exception as e:
-                        out = f"[load error] {e}\n"
-                    conn.sendall(out.encode("utf-8", "ignore") + NULL); continue
-
-                if head == "/max":
-                    if arg:
-                        try:
-                            global MAX_CHARS
-                            MAX_CHARS = max(1, int(arg))
-                        except Exception:
-                            pass
-                        conn.sendall(NULL)
-                    else:
-                        conn.sendall(f"max = {MAX_CHARS}".encode("utf-8","ignore") + NULL)
-                    continue
-
-
-                if head == "/save_set":
-                    path = arg or default_set_path
-                    try:
-                        n = save_knob_set(path, temp=temp, top_p=top_p, top_k=top_k,
-                                          pen_freq=pen_freq, pen_pres=pen_pres, pen_rep=pen_rep,
-                                          min_p=min_p)
-                        out = f"[saved set -> {path} ({n} bytes)]\n"
-                    except Exception as e:
-                        out = f"[save_set error] {e}\n"
-                    conn.sendall(out.encode("utf-8", "ignore") + NULL); continue
-
-                if head == "/load_set":
-                    path = arg or default_set_path
-                    try:
-                        cfg = load_knob_set(path)
-                        temp = cfg["temp"]; top_p = cfg["top_p"]; top_k = cfg["top_k"]
-                        pen_freq = cfg["pen_freq"]; pen_pres = cfg["pen_pres"]; pen_rep = cfg["pen_rep"]
-                        min_p = cfg["min_p"]
-                        out = f"[loaded set <- {path}]\n"
-                    except Exception as e:
-                        out = f"[load_set error] {e}\n"
-                    conn.sendall(out.encode("utf-8", "ignore") + NULL); continue
-
-                if head == "/t":
-                    if arg:
-                        try: temp = float(arg)
-                        except Exception: pass
-                        conn.sendall(NULL)
-                    else:
-                        conn.sendall(f"temp = {temp}".encode("utf-8","ignore") + NULL)
-                    continue
-
-                if head == "/k":
-                    if arg:
-                        try: top_k = int(arg)
-                        except Exception: pass
-                        conn.sendall(NULL)
-                    else:
-                        conn.sendall(f"top_k = {top_k}".encode("utf-8","ignore") + NULL)
-                    continue
-
-                if head == "/p":
-                    if arg:
-                        try: top_p = float(arg)
-                        except Exception: pass
-                        conn.sendall(NULL)
-                    else:
-                        conn.sendall(f"top_p = {top_p}".encode("utf-8","ignore") + NULL)
-                    continue
-
-                if head == "/min_p":
-                    if arg:
-                        try: min_p = float(arg)
-                        except Exception: pass
-                        conn.sendall(NULL)
-                    else:
-                        conn.sendall(f"min_p = {min_p}".encode("utf-8","ignore") + NULL)
-                    continue
-
-                if head == "/pen_freq":
-                    if arg:
-                        try: pen_freq = float(arg)
-                        except Exception: pass
-                        conn.sendall(NULL)
-                    else:
-                        conn.sendall(f"pen_freq = {pen_freq}".encode("utf-8","ignore") + NULL)
-                    continue
-
-                if head == "/pen_pres":
-                    if arg:
-                        try: pen_pres = float(arg)
-                        except Exception: pass
-                        conn.sendall(NULL)
-                    else:
-                        conn.sendall(f"pen_pres = {pen_pres}".encode("utf-8","ignore") + NULL)
-                    continue
-
-                if head == "/pen_rep":
-                    if arg:
-                        try: pen_rep = float(arg)
-                        except Exception: pass
-                        conn.sendall(NULL)
-                    else:
-                        conn.sendall(f"pen_rep = {pen_rep}".encode("utf-8","ignore") + NULL)
-                    continue
-
-                if head == "/?":
-                    out = make_help_text(temp=temp, top_p=top_p, top_k=top_k,
-                                         pen_freq=pen_freq, pen_pres=pen_pres, pen_rep=pen_rep,
-                                         min_p=min_p)
-                    conn.sendall(out.encode("utf-8","ignore") + NULL)
+                handler = HANDLERS.get(head)
+                if handler is not None:
+                    handler(conn, arg)
                     continue
 
                 if head.startswith("/"):
@@ -515,19 +981,25 @@ def main():
                     continue
 
                 # --- normal prompt ---
+                # turns chain straight on the live context; the (multi-MB) state copy is
+                # deferred until something actually saves it
                 try:
-                    reply, state_obj = turn(
+                    reply = turn_generate(
                         llm, line, state_obj,
                         max_chars=MAX_CHARS,
-                        temp=temp, top_p=top_p, top_k=top_k,
-                        pen_freq=pen_freq, pen_pres=pen_pres, pen_rep=pen_rep,
-                        min_p=min_p,
+                        **vars(S),
                     )
-                    _maybe_post_save()
                 except Exception as e:
-                    reply = f"[error] {e}"
+                    # state_obj still names the pre-turn state; the next turn restores it
+                    send_reply(conn, f"[error] {e}".encode("utf-8", "ignore"))
+                    continue
 
-                conn.sendall(reply.encode("utf-8", "ignore") + NULL)
+                send_reply(conn, reply.encode("utf-8", "ignore"))
+                try:
+                    state_obj = turn_capture(llm)
+                    _maybe_post_save()
+                except Exception as e:
+                    print(f"[capture error] {e}", file=sys.stderr, flush=True)
 
             finally:
                 conn.close()
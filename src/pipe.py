@@ -2,6 +2,7 @@
 # Scriptable CLI pipe for SSM runner service with turn templating.
 
 import argparse
+import os
 import socket
 import sys
 from pathlib import Path
@@ -10,6 +11,7 @@ from typing import Optional
 HOST = "127.0.0.1"
 DEFAULT_PORT = 6502
 NULL = b"\x00"
+RECV_CHUNK = 64 * 1024
 
 def read_all_stdin() -> str:
     # Read raw stdin as text; we trim only the final single LF if present.
@@ -18,42 +20,62 @@ def read_all_stdin() -> str:
         s = s[:-1]
     return s
 
-def ensure_counter_file() -> None:
-    p = Path(".counter")
-    if not p.exists():
-        p.write_text("0", encoding="utf-8")
-
 def read_counter() -> int:
-    ensure_counter_file()
-    txt = Path(".counter").read_text(encoding="utf-8").strip()
+    # A missing counter just means no turns have been minted yet.
+    try:
+        txt = Path(".counter").read_text(encoding="utf-8").strip()
+    except FileNotFoundError:
+        return 0
     try:
         return int(txt or "0")
     except ValueError:
         return 0
 
 def write_counter(n: int) -> None:
-    Path(".counter").write_text(str(n), encoding="utf-8")
-
-def send_roundtrip_bytes(payload_text: str, port: int, connect_timeout: float, recv_timeout: Optional[float]) -> bytes:
+    # Write-then-rename so a concurrent reader never sees a truncated counter.
+    Path(".counter.tmp").write_text(str(n), encoding="utf-8")
+    os.replace(".counter.tmp", ".counter")
+
+def set_nodelay(sock: socket.socket) -> None:
+    # Single request/reply per connection: disable Nagle, and on Linux delayed ACKs too.
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    if hasattr(socket, "TCP_QUICKACK"):
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_QUICKACK, 1)
+
+def sendmsg_all(sock: socket.socket, chunks: list[bytes]) -> None:
+    """sendmsg() the whole scatter list, advancing past partially-sent buffers."""
+    views = [memoryview(c) for c in chunks if c]
+    while views:
+        sent = sock.sendmsg(views)
+        while views and sent >= len(views[0]):
+            sent -= len(views.pop(0))
+        if sent:
+            views[0] = views[0][sent:]
+
+def send_roundtrip_bytes(chunks: list[bytes], port: int, connect_timeout: float, recv_timeout: Optional[float]) -> bytes:
     """
-    Send UTF-8 encoded text terminated by NULL; return raw bytes up to (but not including) NULL.
+    Send the pre-encoded chunks followed by NULL as one scatter/gather write;
+    return raw bytes up to (but not including) NULL.
     No decoding here—callers decide how/if to decode. This preserves exact newlines.
     """
-    to_send = payload_text.encode("utf-8") + NULL
     with socket.create_connection((HOST, port), timeout=connect_timeout) as s:
+        set_nodelay(s)
         s.settimeout(recv_timeout)
-        s.sendall(to_send)
-        buf = bytearray()
+        sendmsg_all(s, [*chunks, NULL])
+        # recv_into one growing buffer; only the freshly received bytes are scanned for NULL
+        buf = bytearray(RECV_CHUNK); end = 0
         while True:
-            part = s.recv(4096)
-            if not part:
+            if end == len(buf):
+                buf.extend(bytes(len(buf)))
+            with memoryview(buf) as mv:
+                n = s.recv_into(mv[end:])
+            if not n:
                 raise ConnectionError("connection closed before NULL terminator")
-            i = part.find(NULL)
+            i = buf.find(NULL, end, end + n)
             if i != -1:
-                buf.extend(part[:i])
-                break
-            buf.extend(part)
-    return bytes(buf)
+                del buf[i:]
+                return bytes(buf)
+            end += n
 
 def build_prompt_body(raw: str, in_role: Optional[str], out_role: Optional[str]) -> tuple[str, Optional[int], Optional[int]]:
     """
@@ -83,18 +105,23 @@ def build_prompt_body(raw: str, in_role: Optional[str], out_role: Optional[str])
     body = in_hdr + raw + "\n\n~~~("
     return (body, minted_in, None)
 
-def append_transcript_binary(chunks_text_first: list[str], reply_bytes: bytes, debang_prefix_len: int = 0) -> None:
+def append_transcript_binary(sent_chunks: list[bytes], reply_bytes: bytes) -> None:
     """
-    Append exactly what was sent (as UTF-8 text) and exactly what was received (bytes) to .transcript.txt.
-    If debang is active, strip the first prefix_len bytes (characters) from the first chunk after encoding.
+    Append exactly what was sent (the encoded chunks) and exactly what was received (bytes) to .transcript.txt.
+    Everything goes out as one writev on an O_APPEND fd (no joined copy), so the turn lands
+    in the file in one piece.
     """
-    with open(".transcript.txt", "ab") as f:
-        for idx, c in enumerate(chunks_text_first):
-            b = c.encode("utf-8")
-            if idx == 0 and debang_prefix_len > 0:
-                b = b[debang_prefix_len:]
-            f.write(b)
-        f.write(reply_bytes)
+    bufs = [b for b in (*sent_chunks, reply_bytes) if b]
+    total = sum(len(b) for b in bufs)
+    fd = os.open(".transcript.txt", os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+    try:
+        n = os.writev(fd, bufs) if bufs else 0
+        if n < total:  # short write: finish the remainder with plain writes
+            view = memoryview(b"".join(bufs))[n:]
+            while view:
+                view = view[os.write(fd, view):]
+    finally:
+        os.close(fd)
 
 def main():
     ap = argparse.ArgumentParser(description="PIPE: pipe/paste text to SSM runner with optional transcript templating.")
@@ -118,17 +145,20 @@ def main():
 
     minted_in = minted_out = None
     if is_slash:
-        send_text = prefix + text_in
+        body = text_in
     else:
         try:
             body, minted_in, minted_out = build_prompt_body(text_in, args.in_role, args.out_role)
         except ValueError as ve:
             sys.stderr.write(f"[ERROR] {ve}\n")
             sys.exit(2)
-        send_text = prefix + body
+
+    # Encode once; the same bytes go on the wire and into the transcript.
+    prefix_b = prefix.encode("utf-8")
+    body_b = body.encode("utf-8")
 
     try:
-        reply_bytes = send_roundtrip_bytes(send_text, args.port, args.connect_timeout, args.recv_timeout)
+        reply_bytes = send_roundtrip_bytes([prefix_b, body_b], args.port, args.connect_timeout, args.recv_timeout)
     except Exception as e:
         sys.stderr.write(f"[ERROR] {e}\n")
         sys.exit(1)
@@ -145,18 +175,12 @@ def main():
             write_counter(args.counter_override)
         return
 
-    # Figure transcript-sent chunk (optionally sans prefix)
-    debang_prefix_len = 0
-    transcript_sent = send_text
-    if args.debang and prefix:
-        nl = send_text.find("\n")
-        if nl != -1:
-            debang_prefix_len = nl + 1  # number of characters to drop from encoded bytes
-        else:
-            transcript_sent = ""  # nothing after prefix
+    # Figure transcript-sent chunks (optionally sans the first prefix line)
+    if args.debang and prefix_b:
+        prefix_b = memoryview(prefix_b)[prefix_b.find(b"\n") + 1:]  # a view, not a copy
 
     # Append exactly what was sent (UTF-8) + exactly what was received (bytes)
-    append_transcript_binary([transcript_sent], reply_bytes, debang_prefix_len=debang_prefix_len)
+    append_transcript_binary([prefix_b, body_b], reply_bytes)
 
     # Counter update rules
     if args.counter_override is not None:
@@ -7,7 +7,7 @@
 # - Does NOT include the fence nor the blank line before it in content
 # - Headers must be at start-of-line; won’t match inside code blocks
 
-import sys, os, re, socket, subprocess, tempfile
+import sys, os, re, json, mmap, bisect, socket, subprocess, tempfile
 from pathlib import Path
 from typing import Optional, List, Tuple
 
@@ -17,162 +17,384 @@ NULL = b"\x00"
 
 TRANSCRIPT = Path(".transcript.txt")
 COUNTER    = Path(".counter")
+TURN_CACHE = Path(".transcript.cache")
 
 VERBOSE = False  # set by -v/--verbose
 
 # ---------- Strict turn parsing (blank-line-delimited fence) ----------
-FENCE = "\n\n~~~(end)~~~\n\n"
-# Header must begin at start-of-line; content begins exactly after ": " (one space)
-HEAD_RE = re.compile(r"(?m)^\(Turn\s+(\d+)\)\s*\[([^\]]+)\]:\s*", re.UNICODE)
+FENCE = b"\n\n~~~(end)~~~\n\n"  # matched against the raw transcript bytes
+# Header must begin at start-of-line; content begins exactly after ": " (one space).
+# _scan_heads parses headers (its docstring has the grammar); HEAD_RE_B is the same shape over
+# raw bytes, for scans that only need turn numbers
+HEAD_RE_B = re.compile(rb"(?m)^\(Turn\s+(\d+)\)\s*\[[^\]]+\]:")
 
 def _silent_exit():
     try: sys.exit(0)
     except SystemExit: raise
 
-def _read_text(p: Path) -> str:
-    try: return p.read_text(encoding="utf-8", errors="ignore")
-    except Exception: return ""
-
-def _append_text(p: Path, s: str):
+def _append_text(p: Path, *parts):
+    """Append parts (str, or bytes already encoded as UTF-8) to p with one write on an
+    O_APPEND fd, so the kernel places it at end-of-file even with other writers."""
     try:
-        with p.open("a", encoding="utf-8") as f: f.write(s)
+        data = memoryview(b"".join(s.encode("utf-8") if isinstance(s, str) else s for s in parts))
+        fd = os.open(p, os.O_WRONLY | os.O_APPEND | os.O_CREAT | getattr(os, "O_CLOEXEC", 0), 0o644)
+        try:
+            while data:  # a short write just continues with the rest
+                data = data[os.write(fd, data):]
+        finally:
+            os.close(fd)
     except Exception:
         _silent_exit()
 
-def _recv_until_null(sock, chunk=4096) -> bytes:
-    buf = bytearray()
+def _set_nodelay(sock):
+    # One request, one reply: don't let Nagle / delayed ACK hold either back.
+    try: sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    except Exception: pass
+    if hasattr(socket, "TCP_QUICKACK"):  # Linux only
+        try: sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_QUICKACK, 1)
+        except Exception: pass
+
+def _recv_until_null(sock, chunk=65536) -> bytearray:
+    # recv_into one growing buffer; only the freshly received bytes are scanned for NULL.
+    # The buffer itself is returned (trimmed in place), so the reply is never copied.
+    buf = bytearray(1 << 20); end = 0
     while True:
-        part = sock.recv(chunk)
-        if not part: return b""
-        i = part.find(NULL)
+        if len(buf) - end < chunk:
+            buf.extend(bytes(len(buf)))
+        with memoryview(buf) as mv:
+            n = sock.recv_into(mv[end:end + chunk])
+        if not n: return bytearray()
+        i = buf.find(NULL, end, end + n)
         if i != -1:
-            buf.extend(part[:i])
-            return bytes(buf)
-        buf.extend(part)
-
-def _echo_roundtrip(text: str, connect_timeout=3.0, recv_timeout=None) -> str:
+            del buf[i:]
+            return buf
+        end += n
+
+def _sendmsg_all(sock, chunks):
+    """sendmsg() the whole scatter list, advancing past partially-sent buffers."""
+    views = [memoryview(c) for c in chunks if c]
+    while views:
+        sent = sock.sendmsg(views)
+        while views and sent >= len(views[0]):
+            sent -= len(views.pop(0))
+        if sent:
+            views[0] = views[0][sent:]
+
+def _echo_roundtrip(text, connect_timeout=3.0, recv_timeout=None) -> str:
+    """Send text (str, or UTF-8 bytes as-is) plus NULL; return the decoded reply ("" on error)."""
     try:
-        payload = text.encode("utf-8") + NULL
+        data = text.encode("utf-8") if isinstance(text, str) else text
         with socket.create_connection((HOST, PORT), timeout=connect_timeout) as s:
+            _set_nodelay(s)
             s.settimeout(recv_timeout)
-            s.sendall(payload)
+            _sendmsg_all(s, [data, NULL])  # no payload + NULL copy
             reply = _recv_until_null(s)
             if reply and reply[-1] == 0:
-                reply = reply[:-1]
+                del reply[-1:]
         return reply.decode("utf-8", errors="replace")
     except Exception:
         return ""
 
-def _iter_headers(txt: str):
-    """Yield (match, turn_no:int, role:str) in document order for true headers."""
-    for m in HEAD_RE.finditer(txt):
-        try:
-            n = int(m.group(1)); role = m.group(2)
-        except Exception:
-            continue
-        yield (m, n, role)
-
-def _parse_turns(txt: str):
+def _char_at(buf, i: int):
+    """(char, byte length) of the UTF-8 character at buf[i]; ("", 1) for an invalid byte."""
+    b = buf[i]
+    if b < 0x80: return chr(b), 1
+    k = 2 if b < 0xE0 else 3 if b < 0xF0 else 4
+    try: return bytes(buf[i:i + k]).decode("utf-8"), k
+    except UnicodeDecodeError: return "", 1
+
+# invalid bytes are skipped over like the errors="ignore" decode they replace would drop them
+def _skip_ws(buf, i: int, n: int) -> int:
+    while i < n:
+        ch, k = _char_at(buf, i)
+        if ch and not ch.isspace(): break
+        i += k
+    return i
+
+def _scan_heads(buf, pos: int = 0):
+    """Every turn header in the UTF-8 bytes of buf (bytes or mmap), found with a find() loop.
+
+    A header is, at start of line: "(Turn", one or more whitespace chars, decimal digits,
+    ")", optional whitespace, "[", a role running to the first "]", then ":" and any
+    whitespace after it; i.e. (?m)^\\(Turn\\s+(\\d+)\\)\\s*\\[([^\\]]+)\\]:\\s* on the decoded
+    text, with \\s as str.isspace and \\d as str.isdecimal. Scanning resumes at a header's
+    end. Returns [(start, end, turn_digits, role), ...] with byte offsets."""
+    out = []
+    n = len(buf)
+    while True:
+        j = buf.find(b"(Turn", pos)
+        if j < 0: return out
+        pos = j + 1
+        if j and buf[j - 1] != 0x0A: continue  # not at start of line
+        m = _skip_ws(buf, j + 5, n)
+        if not bytes(buf[j + 5:m]).decode("utf-8", errors="ignore"): continue
+        d = m
+        while m < n:
+            ch, k = _char_at(buf, m)
+            if ch and not ch.isdecimal(): break
+            m += k
+        num = bytes(buf[d:m]).decode("utf-8", errors="ignore")
+        if not num or m >= n or buf[m] != 0x29: continue  # ")"
+        m = _skip_ws(buf, m + 1, n)
+        if m >= n or buf[m] != 0x5B: continue  # "["
+        r = buf.find(b"]", m + 1)
+        if r <= m + 1 or buf[r + 1:r + 2] != b":": continue
+        e = _skip_ws(buf, r + 2, n)
+        out.append((j, e, num, bytes(buf[m + 1:r]).decode("utf-8", errors="ignore")))
+        pos = e
+
+def _turn_spans(buf, heads=None, stop=None):
     """
-    Return list of (turn_no:int, role:str, content:str) where content is the
-    exact substring between the header (one char past ': ') and the **last**
+    Return list of (turn_no:int, role:str, start, end) where buf[start:end] is the
+    exact content between the header (one char past ': ') and the **last**
     strict fence '\\n\\n~~~(end)~~~\\n\\n' that occurs before the next header (or EOF).
     - The fence itself and the blank line before it are NOT included in content.
     - This avoids truncating content that merely *contains* '~~~(end)~~~' text.
     - Only matches headers at start-of-line.
+    buf is the transcript's UTF-8 bytes (bytes or mmap); nothing is decoded but the
+    roles. heads: _scan_heads() of buf if already done; stop: where the last of them
+    ends (default: end of buf).
     """
-    out: List[Tuple[int,str,str]] = []
-    headers = list(_iter_headers(txt))
-    if not headers:
+    out: List[Tuple[int,str,int,int]] = []
+    if heads is None:
+        heads = _scan_heads(buf)
+    if not heads:
         return out
+    if stop is None:
+        stop = len(buf)
 
-    for i, (hm, n, role) in enumerate(headers):
-        start = hm.end()  # content starts exactly one space after the colon
-        span_end = headers[i + 1][0].start() if i + 1 < len(headers) else len(txt)
+    for i, (_, start, num, role) in enumerate(heads):
+        # content starts exactly one space after the colon
+        span_end = heads[i + 1][0] if i + 1 < len(heads) else stop
 
         # Find the **last** strict fence inside this turn's span
-        fence_pos = txt.rfind(FENCE, start, span_end)
+        fence_pos = buf.rfind(FENCE, start, span_end)
         if fence_pos == -1:
             # No strict fence: malformed or still generating; skip to avoid bleed-through
             continue
 
-        content = txt[start:fence_pos]
         # Do NOT strip trailing newline here; we only exclude the required blank line via FENCE
-        out.append((n, role, content))
+        out.append((int(num), role, start, fence_pos))
     return out
 
-def _highest_turn(txt: str) -> int:
-    hi = -1
-    for _, n, _ in _iter_headers(txt):
-        if n > hi: hi = n
-    return hi
+def _mmap_transcript():
+    """Read-only mmap of the transcript, or None if it's missing or empty."""
+    try:
+        with TRANSCRIPT.open("rb") as f:
+            return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    except (OSError, ValueError):  # ValueError: empty file
+        return None
+
+# read_text() (which the tools used to parse) reads "\r\n" and a lone "\r" as "\n"
+CRLF = re.compile(rb"\r\n")
+
+def _parse_transcript(buf):
+    """(_scan_heads(buf), _turn_spans(buf)) with newlines read as read_text() reads them;
+    offsets are always into buf itself."""
+    fix = None
+    if buf.find(b"\r") != -1:
+        raw = buf[:]
+        buf = raw.replace(b"\r\n", b"\n").replace(b"\r", b"\n")
+        # where each "\r\n" now sits as "\n"; an offset past k of them is k bytes short
+        lf = [m.start() - k for k, m in enumerate(CRLF.finditer(raw))]
+        fix = lambda i: i + bisect.bisect_left(lf, i)
+    heads = _scan_heads(buf)
+    spans = _turn_spans(buf, heads)
+    if fix:
+        heads = [(fix(a), fix(b), num, role) for a, b, num, role in heads]
+        spans = [(n, role, fix(a), fix(b)) for n, role, a, b in spans]
+    return heads, spans
+
+# ---------- Parse cache (.transcript.cache) ----------
+# The turn spans (offsets, never the contents) and highest header turn of the transcript
+# as it was at a given size and mtime; any other transcript is parsed afresh. Plain JSON,
+# and anything unexpected in it just means a full parse.
+def _load_turn_cache(st):
+    """(spans, highest turn) cached for the transcript stat()ed as st, else None."""
+    try:
+        with TURN_CACHE.open("rb") as f: c = json.load(f)
+        if c["size"] != st.st_size or c["mtime_ns"] != st.st_mtime_ns: return None
+        spans = [(int(n), str(role), int(a), int(b)) for n, role, a, b in c["spans"]]
+        if not all(0 <= t[2] <= t[3] <= st.st_size for t in spans): return None
+        return spans, int(c["hi"])
+    except Exception: return None
+
+def _save_turn_cache(st, spans, hi: int):
+    # a temp file of our own, so a concurrent tool can't publish a half-written cache
+    tmp = None
+    try:
+        with tempfile.NamedTemporaryFile("w", encoding="utf-8", dir=TURN_CACHE.parent,
+                                         prefix=TURN_CACHE.name + ".", delete=False) as f:
+            tmp = f.name
+            json.dump({"size": st.st_size, "mtime_ns": st.st_mtime_ns, "spans": spans, "hi": hi},
+                      f, separators=(",", ":"))
+        os.replace(tmp, TURN_CACHE)
+    except Exception:
+        if tmp:
+            try: os.unlink(tmp)
+            except OSError: pass
+
+def _ascending(spans) -> bool:
+    """Whether turn numbers strictly rise through spans."""
+    return all(a[0] < b[0] for a, b in zip(spans, spans[1:]))
+
+def _transcript_spans():
+    """(_turn_spans() of the whole transcript, highest header turn or -1, whether the
+    spans' turn numbers strictly ascend), from the cache when the transcript is unchanged.
+    Unfenced turns count towards the highest turn too."""
+    try: st = os.stat(TRANSCRIPT)
+    except OSError: return [], -1, True
+    c = _load_turn_cache(st)
+    if c:
+        spans, hi = c
+        return spans, hi, _ascending(spans)
+    mm = _mmap_transcript()
+    if mm is None:
+        return [], -1, True
+    with mm:
+        heads, spans = _parse_transcript(mm)
+        grew = len(mm) != st.st_size  # appended to since the stat: don't cache under it
+    hi = max((int(h[2]) for h in heads), default=-1)
+    if not grew:
+        _save_turn_cache(st, spans, hi)
+    return spans, hi, _ascending(spans)
+
+def _turn_content(span) -> str:
+    """Read and decode just one span's content from the transcript."""
+    _, _, a, b = span
+    try:
+        with TRANSCRIPT.open("rb") as f:
+            f.seek(a)
+            text = f.read(b - a).decode("utf-8", errors="ignore")
+        return text.replace("\r\n", "\n").replace("\r", "\n") if "\r" in text else text
+    except OSError:
+        _silent_exit()
+
+# Turn numbers only grow, so the highest one sits near the end of the transcript.
+TAIL_BYTES = 65536
+
+def _tail_highest_turn(p: Path = TRANSCRIPT) -> int:
+    """Highest header turn in the last TAIL_BYTES of p, doubling the window back until one shows up."""
+    try:
+        with p.open("rb") as f:
+            end = f.seek(0, 2)
+            raw = b""
+            span = TAIL_BYTES
+            while True:
+                off = max(0, end - span)
+                f.seek(off)
+                raw = f.read(end - off - len(raw)) + raw  # only the newly covered bytes
+                tail = raw
+                if off:  # first line is probably cut; headers must start a line
+                    nl = tail.find(b"\n")
+                    tail = tail[nl + 1:] if nl != -1 else b""
+                if tail.rfind(b"(Turn") != -1:  # cheap test before the regex pass
+                    if b"\r" in tail:  # a lone "\r" ends a line too (see CRLF)
+                        tail = tail.replace(b"\r", b"\n")
+                    hi = max((int(m[1]) for m in HEAD_RE_B.finditer(tail)), default=-1)
+                    if hi >= 0: return hi
+                if off == 0: return -1
+                span *= 2
+    except Exception:
+        pass
+    return -1
 
 # ---------------- core helpers ----------------
 def _ensure_counter():
     if not COUNTER.exists():
         try:
-            hi = max(0, _highest_turn(_read_text(TRANSCRIPT)))
+            hi = max(0, _tail_highest_turn())
             COUNTER.write_text(str(hi), encoding="utf-8")
         except Exception:
             try: COUNTER.write_text("0", encoding="utf-8")
             except Exception: _silent_exit()
 
 def _read_counter() -> int:
-    _ensure_counter()
     try:
-        s = COUNTER.read_text(encoding="utf-8").strip()
+        try:
+            s = COUNTER.read_text(encoding="utf-8").strip()
+        except FileNotFoundError:  # only a missing counter needs seeding
+            _ensure_counter()
+            s = COUNTER.read_text(encoding="utf-8").strip()
         return int(s or "0")
     except Exception:
         try:
-            hi = max(0, _highest_turn(_read_text(TRANSCRIPT)))
+            hi = max(0, _tail_highest_turn())
             COUNTER.write_text(str(hi), encoding="utf-8")
             s = COUNTER.read_text(encoding="utf-8").strip()
             return int(s or "0")
         except Exception:
             return 0
 
-def _next_turn() -> int:
-    n = max(_highest_turn(_read_text(TRANSCRIPT)), _read_counter()) + 1
+def _next_turn(highest: int) -> int:
+    """Mint the next turn number; highest: the transcript's highest header turn, as
+    _transcript_spans() reports it (the one rule every command numbers by)."""
+    n = max(highest, _read_counter()) + 1
     try: COUNTER.write_text(str(n), encoding="utf-8")
     except Exception: _silent_exit()
     return n
 
-def _find_last_role(turns, roles: List[str]) -> Optional[Tuple[int,str,str]]:
+ROLES_FILE = frozenset(["FILE"])
+ROLES_CODE = frozenset(["PYTHON", "BASH"])
+
+def _find_last_role(turns, roles: frozenset, ascending: bool = False) -> Optional[Tuple[int,str,int,int]]:
+    """Highest-numbered turn with one of roles (first one on ties).
+
+    ascending: turn numbers strictly rise through turns, so the last match is that turn."""
+    if ascending:
+        for t in reversed(turns):
+            if t[1] in roles: return t
+        return None
     best = None
-    for n, role, content in turns:
-        if role in roles and (best is None or n > best[0]):
-            best = (n, role, content)
+    for t in turns:
+        if t[1] in roles and (best is None or t[0] > best[0]):
+            best = t
     return best
 
-def _find_turn_by_id(turns, n: int) -> Optional[Tuple[int,str,str]]:
-    for tid, role, content in turns:
-        if tid == n: return (tid, role, content)
+def _find_turn_by_id(turns, n: int, ascending: bool = False) -> Optional[Tuple[int,str,int,int]]:
+    """First turn numbered n; ascending (as for _find_last_role) allows a binary search."""
+    if ascending:
+        lo, hi = 0, len(turns)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if turns[mid][0] < n: lo = mid + 1
+            else: hi = mid
+        return turns[lo] if lo < len(turns) and turns[lo][0] == n else None
+    for t in turns:
+        if t[0] == n: return t
     return None
 
+# every boundary str.splitlines() breaks on
+LINE_BREAKS = re.compile("\r\n|[\n\r\v\f\x1c\x1d\x1e\x85\u2028\u2029]")
+
 def _quote_block(tid: int, role: str, body: str) -> str:
-    lines = body.splitlines()
-    return "\n".join([f"> (Turn {tid}) [{role}]:"] + ["> " + ln for ln in lines])
+    # same lines as "> " + each of body.splitlines(), built with one replace
+    head = f"> (Turn {tid}) [{role}]:"
+    if not body:
+        return head
+    body = LINE_BREAKS.sub("\n", body)
+    if body.endswith("\n"):
+        body = body[:-1]  # splitlines() yields no empty line after a final break
+    return head + "\n> " + body.replace("\n", "\n> ")
 
 # ----------------- GET (GET_FILE) -----------------
 def cmd_GET(argv: List[str]):
     if len(argv) not in (1, 2): _silent_exit()
-    txt = _read_text(TRANSCRIPT)
-    if not txt: _silent_exit()
-    turns = _parse_turns(txt)
+    turns, _, asc = _transcript_spans()
     if not turns: _silent_exit()
 
     if len(argv) == 1:
         out_path = Path(argv[0])
-        chosen = _find_last_role(turns, ["FILE"])
+        chosen = _find_last_role(turns, ROLES_FILE, asc)
     else:
         try: n = int(argv[0])
         except Exception: _silent_exit()
         out_path = Path(argv[1])
-        t = _find_turn_by_id(turns, n)
-        chosen = t if (t and t[1] == "FILE") else None
+        t = _find_turn_by_id(turns, n, asc)
+        chosen = t if (t and t[1] in ROLES_FILE) else None
 
     if not chosen: _silent_exit()
-    _, _, content = chosen
+    content = _turn_content(chosen)
     try:
         out_path.parent.mkdir(parents=True, exist_ok=True)
         out_path.write_text(content, encoding="utf-8")
@@ -186,11 +408,11 @@ def cmd_PUT(argv: List[str]):
     try: content = path.read_text(encoding="utf-8")
     except Exception: _silent_exit()
 
-    n = _next_turn()
-    if not content.endswith("\n"):
-        content += "\n"
+    n = _next_turn(_transcript_spans()[1])
     # IN-half divider (no OUT header). Runner will force to full fence.
-    body = f"(Turn {n}) [FILE]: " + content + "\n~~~("
+    # Encoded once; the same bytes go on the wire and into the transcript.
+    body = b"".join((f"(Turn {n}) [FILE]: ".encode("utf-8"), content.encode("utf-8"),
+                     b"" if content.endswith("\n") else b"\n", b"\n~~~("))
     reply = _echo_roundtrip(body)
 
     if VERBOSE:
@@ -198,10 +420,28 @@ def cmd_PUT(argv: List[str]):
             sys.stdout.write(reply); sys.stdout.flush()
         except Exception: pass
 
-    _append_text(TRANSCRIPT, body)
-    _append_text(TRANSCRIPT, reply)
+    _append_text(TRANSCRIPT, body, reply)
 
 # ----------------- RUN -----------------
+# role -> (temp-file suffix, interpreter argv). Scripts always run from a temp file: under
+# "-c" Python has no __file__ and bash no script path in $0 / BASH_SOURCE.
+RUNNERS = {"BASH": (".sh", ["/bin/bash"]), "PYTHON": (".py", [sys.executable, "-u"])}
+def _run_capture(args: List[str]) -> str:
+    """Run args with stdout+stderr spooled (to disk past 1 MiB) as it arrives; return it
+    decoded the way communicate() in text mode would: strict UTF-8, universal newlines."""
+    with tempfile.SpooledTemporaryFile(max_size=1 << 20) as spool:
+        p = subprocess.Popen(args, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                             cwd=os.getcwd())  # child inherits os.environ as-is
+        with p.stdout:
+            while True:
+                chunk = p.stdout.read1(65536)
+                if not chunk: break
+                spool.write(chunk)
+        p.wait()
+        spool.seek(0)
+        out = spool.read().decode("utf-8")
+    return out.replace("\r\n", "\n").replace("\r", "\n")
+
 def cmd_RUN(argv: List[str]):
     if len(argv) not in (0, 1): _silent_exit()
     n_req = None
@@ -209,58 +449,35 @@ def cmd_RUN(argv: List[str]):
         try: n_req = int(argv[0])
         except Exception: _silent_exit()
 
-    txt = _read_text(TRANSCRIPT)
-    if not txt: _silent_exit()
-    turns = _parse_turns(txt)
+    turns, hi, asc = _transcript_spans()
     if not turns: _silent_exit()
 
     if n_req is None:
-        chosen = _find_last_role(turns, ["PYTHON", "BASH"])
+        chosen = _find_last_role(turns, ROLES_CODE, asc)
     else:
-        t = _find_turn_by_id(turns, n_req)
-        chosen = t if (t and t[1] in ("PYTHON", "BASH")) else None
+        t = _find_turn_by_id(turns, n_req, asc)
+        chosen = t if (t and t[1] in ROLES_CODE) else None
 
     if not chosen: _silent_exit()
-    tid, role, content = chosen
+    tid, role = chosen[:2]
+    content = _turn_content(chosen)
 
-    env = os.environ.copy()
     out = ""
     try:
-        if role == "BASH":
-            with tempfile.NamedTemporaryFile("w", delete=False, encoding="utf-8", suffix=".sh") as tf:
-                tf.write(content); tf.flush(); sh = tf.name
-            try:
-                p = subprocess.Popen(
-                    ["/bin/bash", sh],
-                    stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
-                    text=True, encoding="utf-8", cwd=os.getcwd(), env=env
-                )
-                out, _ = p.communicate()
-                out = out or ""
-            finally:
-                try: os.unlink(sh)
-                except Exception: pass
-
-        elif role == "PYTHON":
-            with tempfile.NamedTemporaryFile("w", delete=False, encoding="utf-8", suffix=".py") as tf:
-                tf.write(content); tf.flush(); py = tf.name
-            try:
-                p = subprocess.Popen(
-                    [sys.executable, "-u", py],
-                    stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
-                    text=True, encoding="utf-8", cwd=os.getcwd(), env=env
-                )
-                out, _ = p.communicate()
-                out = out or ""
-            finally:
-                try: os.unlink(py)
-                except Exception: pass
-        else:
+        if role not in RUNNERS:
             _silent_exit(); return
+        suffix, launcher = RUNNERS[role]
+        with tempfile.NamedTemporaryFile("w", delete=False, encoding="utf-8", suffix=suffix) as tf:
+            tf.write(content); tf.flush(); script = tf.name
+        try:
+            out = _run_capture(launcher + [script])
+        finally:
+            try: os.unlink(script)
+            except Exception: pass
     except Exception:
         _silent_exit(); return
 
-    n = _next_turn()
+    n = _next_turn(hi)
     if not out.endswith("\n"):
         out += "\n"
     body = f"(Turn {n}) [OUTPUT]: " + out + "\n~~~("
@@ -271,8 +488,7 @@ def cmd_RUN(argv: List[str]):
             sys.stdout.write(reply); sys.stdout.flush()
         except Exception: pass
 
-    _append_text(TRANSCRIPT, body)
-    _append_text(TRANSCRIPT, reply)
+    _append_text(TRANSCRIPT, body, reply)
 
 # ---------------- QUOTE ----------------
 def cmd_QUOTE(argv: List[str]):
@@ -280,17 +496,16 @@ def cmd_QUOTE(argv: List[str]):
     try: qn = int(argv[0])
     except Exception: _silent_exit()
 
-    txt = _read_text(TRANSCRIPT)
-    if not txt: _silent_exit()
-    turns = _parse_turns(txt)
+    turns, hi, asc = _transcript_spans()
     if not turns: _silent_exit()
-    t = _find_turn_by_id(turns, qn)
+    t = _find_turn_by_id(turns, qn, asc)
     if not t: _silent_exit()
 
-    tid, role, content = t
+    tid, role = t[:2]
+    content = _turn_content(t)
     quoted = _quote_block(tid, role, content)
 
-    n = _next_turn()
+    n = _next_turn(hi)
     body = f"(Turn {n}) [QUOTE]: " + quoted + "\n\n~~~("
     reply = _echo_roundtrip(body)
 
@@ -299,10 +514,11 @@ def cmd_QUOTE(argv: List[str]):
             sys.stdout.write(reply); sys.stdout.flush()
         except Exception: pass
 
-    _append_text(TRANSCRIPT, body)
-    _append_text(TRANSCRIPT, reply)
+    _append_text(TRANSCRIPT, body, reply)
 
 # ----------------- Main -----------------
+CMDS = {"GET": cmd_GET, "PUT": cmd_PUT, "RUN": cmd_RUN, "QUOTE": cmd_QUOTE}
+
 def main():
     global VERBOSE
     argv = sys.argv[1:]
@@ -317,13 +533,9 @@ def main():
             args.append(a)
     if not args: _silent_exit()
 
-    cmd, rest = args[0].upper(), args[1:]
-
-    if cmd == "GET":   cmd_GET(rest)
-    elif cmd == "PUT": cmd_PUT(rest)
-    elif cmd == "RUN": cmd_RUN(rest)
-    elif cmd == "QUOTE": cmd_QUOTE(rest)
-    else: _silent_exit()
+    cmd = CMDS.get(args[0].upper())
+    if cmd is None: _silent_exit()
+    cmd(args[1:])
 
 if __name__ == "__main__":
     main()